@@ -23,6 +23,24 @@ class DownloadClient(object):
         else:
             return None
 
+    def open_stream(self, url):
+        # Open a streaming download of the given URL, returning a file-like object for the response
+        # body if it was successful.
+        logging.info('Opening stream for URL [%s]', url)
+        response = requests.get(url, stream=True)
+        logging.info('Got HTTP response [%s] from URL [%s]', response, url)
+        if response.status_code == 200:
+            # Make sure any transfer encoding (e.g. gzip) is decoded as the stream is read.
+            response.raw.decode_content = True
+            return response.raw
+        else:
+            logging.warning(
+                'Received non-200 HTTP status code for URL [%s], cannot access target for download',
+                url
+            )
+            response.close()
+            return None
+
     def _get_temp_file_name(self):
         # Generate a temporary file with the appropriate prefix and suffix.
         temp_file = tempfile.mkstemp(prefix='oai_pmh_adaptor-', suffix='.download')
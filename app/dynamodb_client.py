@@ -1,20 +1,65 @@
 import boto3
 import logging
+import time
 
+from botocore.exceptions import ClientError
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from dateutil import parser
+from queue import Empty, Queue
+from threading import Thread
+
+# DynamoDB BatchGetItem accepts at most 100 keys, and BatchWriteItem at most 25 items, in a single
+# request.
+BATCH_GET_MAX_KEYS = 100
+BATCH_WRITE_MAX_ITEMS = 25
+
+# Queued writes are flushed at least this often (in seconds), even if a batch isn't full.
+WRITE_FLUSH_INTERVAL = 0.5
 
 
 class DynamoDBClient(object):
 
-    def __init__(self, watermark_table_name, processed_table_name):
+    def __init__(self, watermark_table_name, processed_table_name, dax_endpoint=None,
+                 processed_ttl=None, session=None, config=None):
         self.watermark_table_name = watermark_table_name
         self.processed_table_name = processed_table_name
+        self.dax_endpoint = dax_endpoint
+        self.processed_ttl = processed_ttl
+        self.session = session or boto3.session.Session()
+        self.config = config
+        self.write_queue = Queue()
+        self.write_error = None
+        self.pending_watermark = None
         self.client = self._initialise_client()
+        self.write_worker_thread = self._initialise_write_worker()
 
     def _initialise_client(self):
+        if self.dax_endpoint:
+            # The DAX client is a drop-in replacement for the Boto3 DynamoDB client, which caches
+            # reads and writes through to DynamoDB. It's only needed when a DAX cluster is used.
+            from amazondax import AmazonDaxClient
+            logging.info('Initialising DAX client with endpoint [%s]', self.dax_endpoint)
+            return AmazonDaxClient(
+                session=self.session,
+                config=self.config,
+                endpoints=[self.dax_endpoint]
+            )
         logging.info('Initialising Boto3 DynamoDB client')
-        return boto3.client('dynamodb')
+        return self.session.client('dynamodb', config=self.config)
+
+    def _initialise_write_worker(self):
+        # Writes are buffered on a queue and written in batches by a background thread, so they
+        # don't hold up the processing of records. The thread is a daemon, so callers must flush
+        # the queue before exiting.
+        write_worker = Thread(
+            target=self._process_write_queue,
+            name='DynamoDBWriteWorker',
+            daemon=True
+        )
+        logging.info('Starting DynamoDB write worker [%s]', write_worker)
+        write_worker.start()
+        return write_worker
 
     def fetch_high_watermark(self):
         # Query DynamoDB to fetch the high watermark. There should only be one row in this table...
@@ -40,27 +85,48 @@ class DynamoDBClient(object):
             return None
 
     def update_high_watermark(self, high_watermark):
-        # Set the high watermark, to be the timestamp given plus 1 second. If we don't add 1
+        # Only the latest high watermark matters, so just hold on to it in memory until it's
+        # flushed, rather than writing it for every record.
+        if self.pending_watermark is None or high_watermark > self.pending_watermark:
+            self.pending_watermark = high_watermark
+
+    def flush_high_watermark(self):
+        # Set the high watermark, to be the pending timestamp plus 1 second. If we don't add 1
         # second, we'll keep fetching the last record over and over.
+        if self.pending_watermark is None:
+            return
+        high_watermark = self.pending_watermark
         logging.info(
             'Setting high watermark [%s] in table [%s]',
             high_watermark,
             self.watermark_table_name
         )
-        self.client.put_item(
-            TableName=self.watermark_table_name,
-            Item={
-                'Key': {
-                    'S': 'HighWatermark'
-                },
-                'Value': {
-                    'S': (high_watermark + timedelta(seconds=1)).isoformat()
+        try:
+            # The condition stops the high watermark ever moving backwards.
+            self.client.update_item(
+                TableName=self.watermark_table_name,
+                Key={
+                    'Key': {
+                        'S': 'HighWatermark'
+                    }
                 },
-                'LastUpdated': {
-                    'S': datetime.now().isoformat()
+                UpdateExpression='SET #V = :new, LastUpdated = :now',
+                ConditionExpression='attribute_not_exists(#V) OR #V < :new',
+                ExpressionAttributeNames={'#V': 'Value'},
+                ExpressionAttributeValues={
+                    ':new': {
+                        'S': (high_watermark + timedelta(seconds=1)).isoformat()
+                    },
+                    ':now': {
+                        'S': datetime.now().isoformat()
+                    }
                 }
-            }
-        )
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            logging.info('High watermark is already beyond [%s]', high_watermark)
+        self.pending_watermark = None
 
     def fetch_processed_status(self, oai_pmh_identifier):
         # Query the DynamoDB table to fetch the status of a record with the given identifier.
@@ -94,6 +160,47 @@ class DynamoDBClient(object):
             )
             return None
 
+    def fetch_processed_statuses(self, oai_pmh_identifiers):
+        # Query the DynamoDB table to fetch the statuses of the records with the given identifiers,
+        # using as few BatchGetItem requests as possible. Identifiers that have never been seen
+        # before won't have a row in the DynamoDB table, so won't appear in the returned dict.
+        logging.info(
+            'Fetching [%s] processed records from table [%s]',
+            len(oai_pmh_identifiers),
+            self.processed_table_name
+        )
+        unique_identifiers = list(set(oai_pmh_identifiers))
+        statuses = {}
+        for i in range(0, len(unique_identifiers), BATCH_GET_MAX_KEYS):
+            statuses.update(self._batch_fetch_processed_statuses(
+                unique_identifiers[i:i + BATCH_GET_MAX_KEYS]
+            ))
+        logging.info('Got [%s] processed record statuses', len(statuses))
+        return statuses
+
+    def _batch_fetch_processed_statuses(self, oai_pmh_identifiers):
+        request_items = {
+            self.processed_table_name: {
+                'Keys': [{'Identifier': {'S': identifier}} for identifier in oai_pmh_identifiers],
+                'ProjectionExpression': 'Identifier, #S',
+                'ExpressionAttributeNames': {'#S': 'Status'}
+            }
+        }
+        statuses = {}
+        attempt = 0
+        while request_items:
+            response = self.client.batch_get_item(RequestItems=request_items)
+            for item in response['Responses'].get(self.processed_table_name, []):
+                statuses[item['Identifier']['S']] = item['Status']['S']
+
+            # DynamoDB may not process every key (e.g. when throttled), so back off exponentially
+            # and request the remainder.
+            request_items = response.get('UnprocessedKeys')
+            if request_items:
+                attempt = attempt + 1
+                self._back_off('Got unprocessed keys fetching processed records', attempt)
+        return statuses
+
     def update_processed_record(self, oai_pmh_identifier, message, status, reason):
         # Add or update the row in the DynamoDB table with the given idetnfier.
         logging.info(
@@ -103,23 +210,101 @@ class DynamoDBClient(object):
             reason,
             self.processed_table_name
         )
-        self.client.put_item(
-            TableName=self.processed_table_name,
-            Item={
-                'Identifier': {
-                    'S': oai_pmh_identifier
-                },
-                'Message': {
-                    'S': message
-                },
-                'Status': {
-                    'S': status
-                },
-                'Reason': {
-                    'S': reason
-                },
-                'LastUpdated': {
-                    'S': datetime.now().isoformat()
-                }
+        item = {
+            'Identifier': {
+                'S': oai_pmh_identifier
+            },
+            'Message': {
+                'S': message
+            },
+            'Status': {
+                'S': status
+            },
+            'Reason': {
+                'S': reason
+            },
+            'LastUpdated': {
+                'S': datetime.now().isoformat()
             }
-        )
+        }
+        if self.processed_ttl:
+            # DynamoDB deletes the row some time after this epoch time, if TTL is enabled on the
+            # table with ExpiresAt as its attribute.
+            item['ExpiresAt'] = {
+                'N': str(int(time.time()) + self.processed_ttl)
+            }
+        self._put_item_on_queue(self.processed_table_name, oai_pmh_identifier, item)
+
+    def flush(self):
+        # Block until every queued write has been written to DynamoDB. If any of them couldn't be
+        # written, raise the error here, as writing them directly would have done.
+        logging.info('Flushing [%s] queued writes to DynamoDB', self.write_queue.qsize())
+        self.write_queue.join()
+        if self.write_error is not None:
+            write_error, self.write_error = self.write_error, None
+            raise write_error
+
+    def _put_item_on_queue(self, table_name, key, item):
+        self.write_queue.put_nowait({
+            'table_name': table_name,
+            'key': key,
+            'item': item
+        })
+
+    def _process_write_queue(self):
+        # Queue processing will run a loop, forever, gathering queued writes into batches. A batch
+        # is written once it's full, or once the flush interval has passed since its first write.
+        while True:
+            writes = [self.write_queue.get()]
+            deadline = time.time() + WRITE_FLUSH_INTERVAL
+
+            # Only the latest write to each item matters, so collapse writes to the same item. This
+            # also avoids BatchWriteItem rejecting a batch containing duplicate keys.
+            items = OrderedDict()
+            items[(writes[0]['table_name'], writes[0]['key'])] = writes[0]
+            while len(items) < BATCH_WRITE_MAX_ITEMS:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    write = self.write_queue.get(timeout=timeout)
+                except Empty:
+                    break
+                writes.append(write)
+                items[(write['table_name'], write['key'])] = write
+
+            try:
+                self._batch_write_items(list(items.values()))
+            except Exception as e:
+                logging.exception('An error occurred writing [%s] items to DynamoDB', len(items))
+                # Hold on to the first error until the queue is next flushed.
+                if self.write_error is None:
+                    self.write_error = e
+            finally:
+                for _ in writes:
+                    self.write_queue.task_done()
+
+    def _batch_write_items(self, writes):
+        logging.info('Writing batch of [%s] items to DynamoDB', len(writes))
+        request_items = {}
+        for write in writes:
+            request_items.setdefault(write['table_name'], []).append({
+                'PutRequest': {
+                    'Item': write['item']
+                }
+            })
+        attempt = 0
+        while request_items:
+            response = self.client.batch_write_item(RequestItems=request_items)
+
+            # DynamoDB may not process every item (e.g. when throttled), so back off exponentially
+            # and write the remainder.
+            request_items = response.get('UnprocessedItems')
+            if request_items:
+                attempt = attempt + 1
+                self._back_off('Got unprocessed items writing to DynamoDB', attempt)
+
+    def _back_off(self, reason, attempt):
+        delay = min(0.05 * (2 ** attempt), 5)
+        logging.warning('%s, retrying in [%s] seconds', reason, delay)
+        time.sleep(delay)
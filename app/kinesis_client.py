@@ -8,18 +8,30 @@ from queue import Queue
 from threading import Thread
 
 
+# Kinesis PutRecords accepts at most 500 records, and at most 5 MiB of data and partition keys, in
+# a single request.
+PUT_RECORDS_MAX_RECORDS = 500
+PUT_RECORDS_MAX_BYTES = 5 * 1024 * 1024
+PUT_RECORDS_MAX_ATTEMPTS = 5
+
+# Partition keys are random UUIDs, which are always 36 characters long.
+PARTITION_KEY_LENGTH = 36
+
+
 class KinesisClient(object):
 
-    def __init__(self, stream_name, invalid_stream_name):
+    def __init__(self, stream_name, invalid_stream_name, session=None, config=None):
         self.stream_name = stream_name
         self.invalid_stream_name = invalid_stream_name
+        self.session = session or boto3.session.Session()
+        self.config = config
         self.message_queue = Queue()
         self.client = self._initialise_client()
         self.queue_worker_thread = self._initialise_queue_worker()
 
     def _initialise_client(self):
         logging.info('Initialising Boto3 Kinesis client')
-        return boto3.client('kinesis')
+        return self.session.client('kinesis', config=self.config)
 
     def _initialise_queue_worker(self):
         try:
@@ -35,7 +47,8 @@ class KinesisClient(object):
 
     def put_message_on_queue(self, message):
         # Append the given message onto the queue.
-        logging.info('Adding message [%s] to the queue', message)
+        logging.info('Adding message to the queue')
+        logging.debug('Adding message [%s] to the queue', message)
         self.message_queue.put_nowait({
             'target_stream': self.stream_name,
             'message': message
@@ -43,12 +56,90 @@ class KinesisClient(object):
 
     def put_invalid_message_on_queue(self, message):
         # Append the given message onto the queue
-        logging.info('Adding invalid message [%s] to the queue', message)
+        logging.info('Adding invalid message to the queue')
+        logging.debug('Adding invalid message [%s] to the queue', message)
         self.message_queue.put_nowait({
             'target_stream': self.invalid_stream_name,
             'message': message
         })
 
+    def put_messages_batch(self, messages):
+        # Put the given messages onto the stream using as few PutRecords requests as possible. The
+        # returned dict maps the index of any message that could not be put, even after retrying,
+        # onto the reason it failed.
+        logging.info(
+            'Putting batch of [%s] messages onto stream [%s]',
+            len(messages),
+            self.stream_name
+        )
+        failures = {}
+        for indexes in self._chunk_messages(messages):
+            failures.update(self._put_records_to_stream(self.stream_name, messages, indexes))
+        return failures
+
+    def _chunk_messages(self, messages):
+        # Group the message indexes into chunks that fit within the limits of a PutRecords request.
+        chunk, chunk_bytes = [], 0
+        for index, message in enumerate(messages):
+            message_bytes = len(self._encode(message)) + PARTITION_KEY_LENGTH
+            if chunk and (len(chunk) == PUT_RECORDS_MAX_RECORDS or
+                          chunk_bytes + message_bytes > PUT_RECORDS_MAX_BYTES):
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append(index)
+            chunk_bytes = chunk_bytes + message_bytes
+        if chunk:
+            yield chunk
+
+    def _put_records_to_stream(self, target_stream, messages, indexes):
+        # PutRecords is not atomic, individual records can fail (typically through throttling) while
+        # the rest succeed. Retry only the failed records, backing off exponentially between
+        # attempts.
+        failures = {}
+        for attempt in range(PUT_RECORDS_MAX_ATTEMPTS):
+            if attempt > 0:
+                delay = 0.1 * (2 ** attempt)
+                logging.warning(
+                    'Retrying [%s] failed records on stream [%s] in [%s] seconds',
+                    len(indexes),
+                    target_stream,
+                    delay
+                )
+                time.sleep(delay)
+            response = self.client.put_records(
+                StreamName=target_stream,
+                Records=[{
+                    'Data': self._encode(messages[index]),
+                    'PartitionKey': str(uuid.uuid4())
+                } for index in indexes]
+            )
+            logging.info(
+                'Put [%s] records onto stream [%s] with [%s] failures',
+                len(indexes),
+                target_stream,
+                response['FailedRecordCount']
+            )
+            if response['FailedRecordCount'] == 0:
+                return {}
+            failures = {
+                index: '{}: {}'.format(record['ErrorCode'], record['ErrorMessage'])
+                for index, record in zip(indexes, response['Records'])
+                if 'ErrorCode' in record
+            }
+            indexes = list(failures.keys())
+        logging.error(
+            'Unable to put [%s] records onto stream [%s] after [%s] attempts',
+            len(failures),
+            target_stream,
+            PUT_RECORDS_MAX_ATTEMPTS
+        )
+        return failures
+
+    def _encode(self, message):
+        if isinstance(message, str):
+            return message.encode('utf-8')
+        return message
+
     def _process_queue(self):
         # Queue processing will run a loop, forever, until the end of time, with 0.5 second
         # snoozes. This prevents the Kinesis Stream from throttling.
@@ -87,7 +178,7 @@ class KinesisClient(object):
     def _put_message_to_stream(self, target_stream, message):
         # Put the message onto the Kinesis Stream, using a random partition key. This should be
         # sufficient to guarantee random shard allocation.
-        logging.info(
+        logging.debug(
             'Putting message [%s] onto stream [%s] with random partition key',
             message,
             target_stream
@@ -98,8 +189,7 @@ class KinesisClient(object):
             PartitionKey=str(uuid.uuid4())
         )
         logging.info(
-            'Put message [%s] onto shard [%s] of stream [%s] with sequence number [%s]',
-            message,
+            'Put message onto shard [%s] of stream [%s] with sequence number [%s]',
             response['ShardId'],
             target_stream,
             response['SequenceNumber']
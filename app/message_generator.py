@@ -16,6 +16,19 @@ class MessageGenerator(object):
         self.env = self._initialise_environment()
         self.now = datetime.now(timezone.utc).isoformat()
 
+        # None of the following change between records, so work them out once up front rather than
+        # every time a message is generated.
+        self.template = self._initialise_template()
+        self.message_history = {
+            'machineId': 'rdss-oai-pmh-adaptor-{}'.format(self.oai_pmh_provider),
+            'machineAddress': self._get_machine_address(),
+            'timestamp': self.now
+        }
+        self.organisation = {
+            'organisationJiscId': self.jisc_id,
+            'organisationName': self.organisation_name
+        }
+
     def _initialise_environment(self):
         logging.info('Loading templates in directory [templates] from package [app]')
         # We use Jinja2 to template the messages, this block prepares the Jinja2 environment.
@@ -27,6 +40,10 @@ class MessageGenerator(object):
             )
         )
 
+    def _initialise_template(self):
+        logging.info('Fetching template [metadata_create.jsontemplate]')
+        return self.env.get_template('metadata_create.jsontemplate')
+
     def _parse_datetime_with_tz(self, datetime_string):
         parsed_dt = parser.parse(datetime_string)
         if not parsed_dt.tzinfo:
@@ -36,11 +53,9 @@ class MessageGenerator(object):
     def generate_metadata_create(self, record, s3_objects):
         # Generate the message by building up a dict of values and passing this into Jinja2. The
         # .jsontemplate file will be parsed and decorated with these values.
-        logging.info('Fetching template [metadata_create.jsontemplate]')
-        template = self.env.get_template('metadata_create.jsontemplate')
-        logging.info('Rendering template using record [%s]', record)
+        logging.info('Rendering template using record [%s]', record['identifier'])
         dc_metadata = record['oai_dc']
-        return template.render({
+        return self.template.render({
             'messageHeader': {
                 'messageId': uuid.uuid4(),
                 'messageTimings': {
@@ -49,11 +64,7 @@ class MessageGenerator(object):
                 'messageSequence': {
                     'sequence': uuid.uuid4()
                 },
-                'messageHistory': {
-                    'machineId': 'rdss-oai-pmh-adaptor-{}'.format(self.oai_pmh_provider),
-                    'machineAddress': self._get_machine_address(),
-                    'timestamp': self.now
-                },
+                'messageHistory': self.message_history,
                 'generator': self.oai_pmh_provider
             },
             'messageBody': {
@@ -88,7 +99,7 @@ class MessageGenerator(object):
     def _single_value_from_dc_metadata(self, dc_metadata, key):
         values = dc_metadata.get(key)
         if not values:
-            logging.warning('DC metadata [%s] does not contain [\'%s\'] field', dc_metadata, key)
+            logging.warning('DC metadata does not contain [\'%s\'] field', key)
             return None
         if len(values) > 1:
             logging.warning('DC metadata [\'%s\'] has more than 1 value', key)
@@ -97,7 +108,7 @@ class MessageGenerator(object):
     def _unique_value_list_from_dc_metadata(self, dc_metadata, key):
         values = dc_metadata.get(key)
         if not values:
-            logging.warning('DC metadata [%s] does not contain [\'%s\'] field', dc_metadata, key)
+            logging.warning('DC metadata does not contain [\'%s\'] field', key)
             return []
         return list(set(values))
 
@@ -131,10 +142,7 @@ class MessageGenerator(object):
                     'personGivenName': name,
                     'personOrganisationUnit': {
                         'organisationUnitUuid': uuid.uuid4(),
-                        'organisation': {
-                            'organisationJiscId': self.jisc_id,
-                            'organisationName': self.organisation_name
-                        }
+                        'organisation': self.organisation
                     }
                 },
                 'role': role_enum
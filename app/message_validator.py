@@ -1,9 +1,12 @@
 import json
 import logging
+import orjson
 import os
+import threading
 
 from app import DownloadClient
-from jsonschema import validate, FormatChecker, RefResolver
+from jsonschema import FormatChecker, RefResolver
+from jsonschema.validators import validator_for
 
 MODEL_SCHEMA_BASE_URL = 'https://raw.githubusercontent.com/JiscRDSS/rdss-message-api-specificatio' \
                         'n/{api_version}/schemas/{schema_document}'
@@ -44,6 +47,8 @@ class MessageValidator(object):
         self.download_client = DownloadClient()
         self.model_schema_mappings = self._download_model_schemas()
         self.message_schema_file_path = self._download_message_schema()
+        self.message_schema, self.model_schema_store = self._load_schemas()
+        self.validators = threading.local()
 
     def _download_model_schemas(self):
         model_schema_mappings = []
@@ -81,27 +86,40 @@ class MessageValidator(object):
         )
         return message_schema_file
 
+    def _load_schemas(self):
+        # Loading the schema documents and checking the message schema is comparatively expensive,
+        # so it's done once, and the results reused for every message.
+        logging.info('Loading schemas for API specification version [%s]', self.api_version)
+        message_schema = self._get_json(self.message_schema_file_path)
+        validator_for(message_schema).check_schema(message_schema)
+        model_schema_store = {
+            schema_id: self._get_json(file_path)
+            for schema_id, file_path in self.model_schema_mappings
+        }
+        return message_schema, model_schema_store
+
+    def _get_validator(self):
+        # A RefResolver tracks its resolution scope as it validates, so validators can't be shared
+        # between threads. Each thread gets its own, built on first use.
+        validator = getattr(self.validators, 'validator', None)
+        if validator is None:
+            validator = validator_for(self.message_schema)(
+                self.message_schema,
+                resolver=RefResolver('', {}, store=self.model_schema_store),
+                format_checker=FormatChecker()
+            )
+            self.validators.validator = validator
+        return validator
+
     def validate_message(self, message):
-        logging.info(
+        logging.debug(
             'Validating message [%s] against API specification version [%s]',
             message,
             self.api_version
         )
 
         # Validate the JSON payload against the JSON schema
-        validate(
-            json.loads(message),
-            self._get_json(self.message_schema_file_path),
-            resolver=RefResolver(
-                '',
-                {},
-                store={
-                    schema_id: self._get_json(file_path)
-                    for schema_id, file_path in self.model_schema_mappings
-                }
-            ),
-            format_checker=FormatChecker()
-        )
+        self._get_validator().validate(orjson.loads(message))
 
     def _get_json(self, file_path):
         with open(file_path) as json_data:
@@ -1,10 +1,17 @@
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
 from oaipmh.client import Client
-from oaipmh.metadata import MetadataRegistry, oai_dc_reader
+from oaipmh.metadata import MetadataRegistry
 from oaipmh.error import NoRecordsMatchError
+from .oaidc.reader import oai_dc_lazy_reader
 from .oaiore.reader import oai_ore_reader
 
+# Identifiers with these prefixes are the locations of the record's files.
+FILE_LOCATION_PREFIXES = ('http://', 'https://')
+
+ORE_AGGREGATES_RELATION = 'http://www.openarchives.org/ore/terms/aggregates'
+
 
 class OAIPMHClient(object):
 
@@ -14,19 +21,26 @@ class OAIPMHClient(object):
 
     def _initialise_client(self, url):
         registry = MetadataRegistry()
-        registry.registerReader('oai_dc', oai_dc_reader)
+        registry.registerReader('oai_dc', oai_dc_lazy_reader)
         registry.registerReader('ore', oai_ore_reader)
         logging.info('Initialising OAI client with URL [%s]', url)
         return Client(url, registry)
 
     def fetch_records_from(self, from_datetime, until_datetime=None):
-        records = self._fetch_records_by_prefix_from('oai_dc', from_datetime, until_datetime)
+        if self.use_ore:
+            # The oai_dc and ore listings are independent, so page through them concurrently.
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                oai_dc_future = executor.submit(
+                    self._fetch_records_by_prefix_from, 'oai_dc', from_datetime, until_datetime)
+                oai_ore_future = executor.submit(
+                    self._fetch_records_by_prefix_from, 'ore', from_datetime, until_datetime)
+                records, oai_ore_records = oai_dc_future.result(), oai_ore_future.result()
+        else:
+            records = self._fetch_records_by_prefix_from('oai_dc', from_datetime, until_datetime)
         if not records:
             # If we don't get DC records, we won't get anything.
             return []
         if self.use_ore:
-            oai_ore_records = self._fetch_records_by_prefix_from(
-                'ore', from_datetime, until_datetime)
             records = self._merge_records(records, oai_ore_records)
         records = self._filter_empty_records(records)
         for r in records.values():
@@ -87,14 +101,12 @@ class OAIPMHClient(object):
             return None
 
     def _extract_file_locations(self, record):
-        file_locations = []
         if self.use_ore:
-            for l in record['ore'].get('link', []):
-                relation = l.get('rel', '')
-                if relation == 'http://www.openarchives.org/ore/terms/aggregates':
-                    file_locations.append(l.get('href', ''))
-        else:
-            for identifier in record['oai_dc'].get('identifier', []):
-                if identifier.startswith(('http://', 'https://')):
-                    file_locations.append(identifier)
-        return list(filter(None, file_locations))
+            return [
+                link.get('href', '') for link in record['ore'].get('link', [])
+                if link.get('rel', '') == ORE_AGGREGATES_RELATION and link.get('href', '')
+            ]
+        return [
+            identifier for identifier in record['oai_dc'].get('identifier', [])
+            if identifier.startswith(FILE_LOCATION_PREFIXES)
+        ]
@@ -0,0 +1,68 @@
+from collections.abc import Mapping
+from lxml import etree
+from oaipmh.metadata import MetadataReader, Error, oai_dc_reader, text_type
+from oaipmh import common
+
+
+class LazyMetadataReader(MetadataReader):
+    """	Defers the evaluation of the fields of the MetadataReader found in
+        the pyoai library until they are first accessed, so that records
+        which are never processed don't pay for parsing their metadata.
+        """
+
+    def __call__(self, element):
+        return common.Metadata(element, LazyMetadataMap(element, self._fields, self._namespaces))
+
+
+class LazyMetadataMap(Mapping):
+    """	A read-only mapping of field names to values, where each value is
+        extracted from the metadata element the first time it is accessed.
+        """
+
+    def __init__(self, element, fields, namespaces):
+        self._element = element
+        self._fields = fields
+        self._namespaces = namespaces
+        self._xpath_evaluator = None
+        self._values = {}
+
+    def __getitem__(self, field_name):
+        if field_name not in self._values:
+            field_type, expr = self._fields[field_name]
+            self._values[field_name] = self._evaluate(field_type, expr)
+        return self._values[field_name]
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def _evaluate(self, field_type, expr):
+        if self._xpath_evaluator is None:
+            self._xpath_evaluator = etree.XPathEvaluator(self._element,
+                                                         namespaces=self._namespaces)
+        e = self._xpath_evaluator
+        if field_type == 'bytes':
+            return str(e(expr))
+        elif field_type == 'bytesList':
+            return [str(item) for item in e(expr)]
+        elif field_type == 'text':
+            # make sure we get back unicode strings instead
+            # of lxml.etree._ElementUnicodeResult objects.
+            return text_type(e(expr))
+        elif field_type == 'textList':
+            # make sure we get back unicode strings instead
+            # of lxml.etree._ElementUnicodeResult objects.
+            return [text_type(v) for v in e(expr)]
+        else:
+            raise Error('Unknown field type: %s' % field_type)
+
+
+oai_dc_lazy_reader = LazyMetadataReader(
+    fields=oai_dc_reader._fields,
+    namespaces=oai_dc_reader._namespaces
+)
@@ -4,18 +4,32 @@ import base64
 import logging
 import ntpath
 
+from boto3.s3.transfer import TransferConfig
 from urllib.parse import urlparse
 
+# Streams are uploaded in 8 MiB parts, two at a time. Every upload gets its own transfer threads,
+# and files are already uploaded concurrently by the file and record workers, so each upload is
+# kept small: at most 2 threads and 2 parts (16 MiB) of a stream held in memory.
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=2,
+    use_threads=True
+)
+TRANSFER_CONFIG.max_in_memory_upload_chunks = 2
+
 
 class S3Client(object):
 
-    def __init__(self, bucket_name):
+    def __init__(self, bucket_name, session=None, config=None):
         self.bucket_name = bucket_name
+        self.session = session or boto3.session.Session()
+        self.config = config
         self.client = self._initialise_client()
 
     def _initialise_client(self):
         logging.info('Initialising Boto3 S3 client')
-        return boto3.client('s3')
+        return self.session.client('s3', config=self.config)
 
     def push_to_bucket(self, remote_url, file_path):
         # Get a handle on the S3 object key
@@ -72,6 +86,60 @@ class S3Client(object):
             'download_url': 's3://{}/{}'.format(self.bucket_name, object_key)
         }
 
+    def upload_fileobj(self, remote_url, fileobj):
+        # Get a handle on the S3 object key
+        object_key = self._build_object_key(remote_url)
+
+        # Stream the file-like object into S3 using a multipart upload. The MD5 checksum and size
+        # of the object are calculated as it's read, as neither is known upfront.
+        logging.info(
+            'Streaming file to S3 Bucket [%s] with key [%s]',
+            self.bucket_name,
+            object_key
+        )
+        checksum_reader = ChecksumReader(fileobj)
+        self.client.upload_fileobj(
+            checksum_reader,
+            self.bucket_name,
+            object_key,
+            Config=TRANSFER_CONFIG
+        )
+        md5_checksum = checksum_reader.checksum()
+        logging.info(
+            'Finished streaming file to S3 Bucket [%s] with key [%s]',
+            self.bucket_name,
+            object_key
+        )
+
+        # Object metadata has to be given when an object is created, so now that the checksum is
+        # known, copy the object over itself to attach it.
+        logging.info(
+            'Setting S3 object metadata for object [%s] in S3 Bucket [%s]',
+            object_key,
+            self.bucket_name
+        )
+        self.client.copy_object(
+            Bucket=self.bucket_name,
+            Key=object_key,
+            CopySource={
+                'Bucket': self.bucket_name,
+                'Key': object_key
+            },
+            Metadata={
+                'md5chksum': md5_checksum
+            },
+            MetadataDirective='REPLACE'
+        )
+
+        # Build up a dict of object metadata that is consumable by the caller of this method.
+        return {
+            'file_name': ntpath.basename(object_key),
+            'file_path': object_key,
+            'file_size': checksum_reader.size,
+            'file_checksum': md5_checksum,
+            'download_url': 's3://{}/{}'.format(self.bucket_name, object_key)
+        }
+
     def _build_object_key(self, remote_url):
         # Strip the protocol, hostname and port off of the URL, leaving just the path behind. S3
         # object keys also shouldn't start with a leading slash, so strip that too.
@@ -90,3 +158,22 @@ class S3Client(object):
         checksum = base64.b64encode(hash_md5.digest()).decode('utf-8')
         logging.info('Got MD5 checksum value [%s] for file[%s]', checksum, file_path)
         return checksum
+
+
+class ChecksumReader(object):
+    """ Wraps a file-like object, calculating the MD5 checksum and size of the data as it is read.
+        """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash_md5 = hashlib.md5()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash_md5.update(data)
+        self.size = self.size + len(data)
+        return data
+
+    def checksum(self):
+        return base64.b64encode(self.hash_md5.digest()).decode('utf-8')
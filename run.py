@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
-import json
+import boto3
+import botocore.config
+import concurrent.futures
+import functools
 import logging
+import multiprocessing
+import orjson
 import os
 import sys
-import itertools
 
 from app import OAIPMHClient
 from app import DownloadClient
@@ -21,42 +25,98 @@ logging.basicConfig(
     format='%(asctime)s [%(threadName)s] [%(levelname)s] %(name)s - %(message)s'
 )
 
-download_client = None
-dynamodb_client = None
-oai_pmh_client = None
-kinesis_client = None
-message_generator = None
-message_validator = None
-s3_client = None
+# The longest period of time queried from the OAI endpoint at once.
+MAX_OAI_PMH_WINDOW = datetime.timedelta(days=32)
+
+# Flush pending messages before a batch gets too close to the 5 MiB PutRecords request limit.
+KINESIS_BATCH_FLUSH_BYTES = 4 * 1024 * 1024
+
+# Processed statuses are fetched for this many records at a time, the most a single DynamoDB
+# BatchGetItem request accepts.
+PROCESSED_STATUS_CHUNK_SIZE = 100
+
+# Shared by the Boto3 clients. The connection pool is big enough for the record, file and S3
+# transfer workers to hold on to their connections between requests, and the extra retries give
+# Kinesis and DynamoDB longer to recover when they throttle requests.
+BOTO3_CONFIG = botocore.config.Config(
+    max_pool_connections=64,
+    retries={'max_attempts': 10}
+)
+
+# The context that message generation worker processes use. It's set before the worker processes
+# are forked, so that they inherit the message generator and validator rather than having them
+# pickled and sent for every record.
+worker_context = None
+
+
+class Context(object):
+    """ Holds the clients, generator, etc. used to process records, which are passed explicitly
+        to the functions that need them rather than being held in module globals.
+        """
+    __slots__ = (
+        'boto3_session',
+        'cpu_executor',
+        'download_client',
+        'dynamodb_client',
+        'file_executor',
+        'oai_pmh_client',
+        'kinesis_client',
+        'message_generator',
+        'message_validator',
+        'record_executor',
+        's3_client'
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+
+class MessageGenerationError(Exception):
+    """ Raised when the RDSS message for a record can't be generated, or isn't valid. Carries the
+        error code and reason, and whatever of the message was generated, so that the message can
+        be decorated with the error.
+        """
+
+    def __init__(self, err_code, reason, message=None, message_obj=None):
+        super().__init__(err_code, reason, message, message_obj)
+        self.err_code = err_code
+        self.reason = reason
+        self.message = message
+        self.message_obj = message_obj
 
 
 def main():
     # Fetch the application settings.
     settings = _get_settings()
 
-    # Initialise the various clients, generator, etc.
-    global download_client
-    download_client = _initialise_download_client()
-    global dynamodb_client
-    dynamodb_client = _initialise_dynamodb_client(settings)
-    global oai_pmh_client
-    oai_pmh_client = _initialise_oai_pmh_client(settings)
-    global kinesis_client
-    kinesis_client = _initialise_kinesis_client(settings)
-    global message_generator
-    message_generator = _initialise_message_generator(settings)
-    global message_validator
-    message_validator = _initialise_message_validator(settings)
-    global s3_client
-    s3_client = _initialise_s3_client(settings)
+    # Whatever happens, make sure everything that was initialised gets shut down.
+    context = Context()
+    try:
+        _run(context, settings)
+    finally:
+        _shutdown(context)
+
+
+def _run(context, settings):
+    # Initialise the various clients, generator, etc. The message generation worker processes are
+    # forked before any of the clients start background threads.
+    context.message_generator = _initialise_message_generator(settings)
+    context.message_validator = _initialise_message_validator(settings)
+    context.cpu_executor = _initialise_cpu_executor(context, settings)
+    context.boto3_session = _initialise_boto3_session()
+    context.download_client = _initialise_download_client()
+    context.dynamodb_client = _initialise_dynamodb_client(context, settings)
+    context.oai_pmh_client = _initialise_oai_pmh_client(settings)
+    context.kinesis_client = _initialise_kinesis_client(context, settings)
+    context.s3_client = _initialise_s3_client(context, settings)
+    context.file_executor = _initialise_file_executor(settings)
+    context.record_executor = _initialise_record_executor(settings)
+    dynamodb_client = context.dynamodb_client
+    flow_limit = int(settings['OAI_PMH_ADAPTOR_FLOW_LIMIT'])
 
     def get_records(start_timestamp, until_timestamp=None):
-        """ """
-        flow_limit = int(settings['OAI_PMH_ADAPTOR_FLOW_LIMIT'])
-        # Query OAI endpoint for all the records since the high watermark.
-        records = oai_pmh_client.fetch_records_from(start_timestamp, until_timestamp)
-        # Filter out records that have already been successfully processed
-        return itertools.islice(filter(_record_success_filter, records), flow_limit)
+        return _fetch_unprocessed_records(context, flow_limit, start_timestamp, until_timestamp)
 
     # Query DynamoDB for the high watermark. If it exists, use that, otherwise this is probably a
     # "first run", so set the watermark to a date in the past to catch all records.
@@ -65,34 +125,58 @@ def main():
         start_timestamp = datetime.datetime(2000, 1, 1, 0, 0)
         dynamodb_client.update_high_watermark(start_timestamp)
 
+    # Query the OAI endpoint in windows, starting with a single day. Every time a window has no
+    # records left to process, the next one is twice as long, so that long quiet periods (e.g. on
+    # a first run) take a handful of queries rather than one per day.
     today = datetime.datetime.today()
+    window = datetime.timedelta(days=1)
     records = []
     while not records:
-        if start_timestamp.date() == today.date():
-            logging.info('Start timestamp %s is today %s', start_timestamp.date(), today.date())
+        until_timestamp = start_timestamp + window
+        if start_timestamp.date() == today.date() or until_timestamp.date() > today.date():
+            logging.info('Start timestamp %s is within %s of today %s',
+                         start_timestamp.date(), window, today.date())
             records = get_records(start_timestamp)
             break
         else:
-            until_timestamp = start_timestamp + datetime.timedelta(days=1)
-            records = list(get_records(start_timestamp, until_timestamp))
+            records = get_records(start_timestamp, until_timestamp)
             start_timestamp = until_timestamp
-
-    for record in records:
-        logging.info('Processing record [%s]', record)
-        _process_record(record)
-
-    # We're done, shut down
-    _shutdown()
+            window = min(window * 2, MAX_OAI_PMH_WINDOW)
+
+    # Messages are put onto the stream in batches, so hold on to the outcome of each record until
+    # its batch has been flushed.
+    batch_size = int(settings['OUTPUT_KINESIS_BATCH_SIZE'])
+    # Records spend most of their time waiting on the network, so several are processed
+    # concurrently. The results come back in order, so the high watermark only ever moves forward.
+    process_record = functools.partial(_process_record, context)
+    pending, pending_bytes = [], 0
+    for record, processed in zip(records, context.record_executor.map(process_record, records)):
+        pending.append((record, processed))
+        if processed[2] == 'Success':
+            pending_bytes = pending_bytes + len(processed[1])
+        if len(pending) >= batch_size or pending_bytes >= KINESIS_BATCH_FLUSH_BYTES:
+            _flush_pending(context, pending)
+            pending, pending_bytes = [], 0
+    _flush_pending(context, pending)
+
+
+def _initialise_boto3_session():
+    logging.info('Initialising Boto3 session')
+    return boto3.session.Session()
 
 
 def _initialise_download_client():
     return DownloadClient()
 
 
-def _initialise_dynamodb_client(settings):
+def _initialise_dynamodb_client(context, settings):
     return DynamoDBClient(
         settings['DYNAMODB_WATERMARK_TABLE_NAME'],
-        settings['DYNAMODB_PROCESSED_TABLE_NAME']
+        settings['DYNAMODB_PROCESSED_TABLE_NAME'],
+        settings['DYNAMODB_DAX_ENDPOINT'],
+        int(settings['DYNAMODB_PROCESSED_TTL_SECONDS']),
+        session=context.boto3_session,
+        config=BOTO3_CONFIG
     )
 
 
@@ -112,10 +196,12 @@ def _initialise_oai_pmh_client(settings):
     )
 
 
-def _initialise_kinesis_client(settings):
+def _initialise_kinesis_client(context, settings):
     return KinesisClient(
         settings['OUTPUT_KINESIS_STREAM_NAME'],
-        settings['OUTPUT_KINESIS_INVALID_STREAM_NAME']
+        settings['OUTPUT_KINESIS_INVALID_STREAM_NAME'],
+        session=context.boto3_session,
+        config=BOTO3_CONFIG
     )
 
 
@@ -131,97 +217,228 @@ def _initialise_message_validator(settings):
     return MessageValidator(settings['RDSS_MESSAGE_API_SPECIFICATION_VERSION'])
 
 
-def _initialise_s3_client(settings):
-    return S3Client(settings['S3_BUCKET_NAME'])
+def _initialise_s3_client(context, settings):
+    return S3Client(
+        settings['S3_BUCKET_NAME'],
+        session=context.boto3_session,
+        config=BOTO3_CONFIG
+    )
+
+
+def _initialise_file_executor(settings):
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=int(settings['OAI_PMH_ADAPTOR_FILE_WORKERS']),
+        thread_name_prefix='FileWorker'
+    )
+
+
+def _initialise_record_executor(settings):
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=int(settings['OAI_PMH_ADAPTOR_RECORD_WORKERS']),
+        thread_name_prefix='RecordWorker'
+    )
+
+
+def _initialise_cpu_executor(context, settings):
+    cpu_workers = int(settings['OAI_PMH_ADAPTOR_CPU_WORKERS'])
+    if cpu_workers < 1:
+        return None
+    # The worker processes inherit the worker context, rather than having it pickled, so they must
+    # be forked.
+    if multiprocessing.get_start_method() != 'fork':
+        logging.error(
+            'OAI_PMH_ADAPTOR_CPU_WORKERS requires the fork start method, not [%s]',
+            multiprocessing.get_start_method()
+        )
+        sys.exit(1)
+    global worker_context
+    worker_context = context
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=cpu_workers)
+    _fork_worker_processes(executor)
+    return executor
+
+
+def _fork_worker_processes(executor):
+    # A process pool forks all of its worker processes when the first task is submitted, so submit
+    # a task that does nothing and wait for it, while no other threads have been started.
+    executor.submit(int).result()
+
+
+def _fetch_unprocessed_records(context, flow_limit, start_timestamp, until_timestamp=None):
+    # Query OAI endpoint for all the records since the high watermark.
+    records = context.oai_pmh_client.fetch_records_from(start_timestamp, until_timestamp)
+
+    # Filter out records that have already been successfully processed. The records are in
+    # datestamp order, so their statuses are fetched a chunk at a time, stopping once there are
+    # enough records to process.
+    unprocessed_records = []
+    for i in range(0, len(records), PROCESSED_STATUS_CHUNK_SIZE):
+        chunk = records[i:i + PROCESSED_STATUS_CHUNK_SIZE]
+        statuses = context.dynamodb_client.fetch_processed_statuses(
+            [record['identifier'] for record in chunk]
+        )
+        unprocessed_records.extend(
+            record for record in chunk if _record_success_filter(record, statuses)
+        )
+        if len(unprocessed_records) >= flow_limit:
+            break
+    return unprocessed_records[:flow_limit]
 
 
-def _record_success_filter(record):
-    """ Filters out records that have already been processed successfully.
+def _record_success_filter(record, statuses):
+    """ Filters out records that have already been processed successfully, given the statuses
+        fetched for the records in bulk.
         """
-    status = dynamodb_client.fetch_processed_status(record['identifier'])
+    identifier = record['identifier']
+    status = statuses.get(identifier)
     logging.info(
         'Got processed status [%s] for identifier [%s]',
         status,
-        record['identifier']
+        identifier
     )
     if status == 'Success':
         logging.info(
             'Record [%s] already successfully processed, skipping',
-            record['identifier']
+            identifier
         )
         return False
     else:
         return True
 
 
-def _process_record(record):
-    logging.info('Processing record [%s]', record['identifier'])
-    message, status, reason, err_code = None, 'Success', '-', None
+def _process_record(context, record):
+    identifier = record['identifier']
+    logging.info('Processing record [%s]', identifier)
+    message, message_obj, status, reason, err_code = None, None, 'Success', '-', None
     try:
         # Fetch from EPrints and push the files associated with the record into S3.
-        s3_objects = _push_files_to_s3(record)
+        s3_objects = _push_files_to_s3(context, record)
 
         # Generate the RDSS compliant message from the EPrints record.
-        message = message_generator.generate_metadata_create(record, s3_objects)
+        if context.cpu_executor is None:
+            message = _generate_message(context, record, s3_objects)
+        else:
+            message = context.cpu_executor.submit(
+                _generate_message_in_worker,
+                _plain_record(record),
+                s3_objects
+            ).result()
+
+    except MessageGenerationError as e:
+        status, reason, err_code = 'Failure', e.reason, e.err_code
+        message, message_obj = e.message, e.message_obj
+    except Exception as e:
+        logging.exception('An error occurred processing EPrints record [%s]', identifier)
+        status, reason, err_code = 'Failure', str(e), 'GENERR009'
 
-        try:
-            # Convert the message into a JSON payload and back again
-            message = json.dumps(json.loads(message, strict=False))
-        except Exception:
-            err_code = 'GENERR007'
-            raise
+    if status == 'Failure':
+        message = _decorate_message_with_error(message, err_code, reason, message_obj)
+        context.kinesis_client.put_invalid_message_on_queue(message)
+
+    # Valid messages are put onto the stream when the pending batch is flushed.
+    return identifier, message, status, reason
+
+
+def _generate_message(context, record, s3_objects):
+    """ Generates and validates the RDSS message for the record. This is purely CPU bound, so may be
+        run in a worker process.
+        """
+    message, message_obj, err_code = None, None, 'GENERR009'
+    try:
+        message = context.message_generator.generate_metadata_create(record, s3_objects)
 
-        try:
-            # Belts and braces check to make sure the message is valid
-            message_validator.validate_message(message)
-        except Exception:
-            err_code = 'GENERR001'
-            raise
+        # Convert the message into a JSON payload and back again, holding on to the parsed message
+        # in case it needs to be decorated with an error.
+        err_code = 'GENERR007'
+        message_obj = orjson.loads(message)
+        message = orjson.dumps(message_obj).decode('utf-8')
 
-        # Put the RDSS message onto the message queue.
-        kinesis_client.put_message_on_queue(message)
+        # Belts and braces check to make sure the message is valid
+        err_code = 'GENERR001'
+        context.message_validator.validate_message(message)
+        return message
 
     except Exception as e:
-        logging.exception('An error occurred processing EPrints record [%s]', record)
-        if err_code is None:
-            err_code = 'GENERR009'
-        status, reason = 'Failure', str(e)
-        message = _decorate_message_with_error(message, err_code, reason)
-        kinesis_client.put_invalid_message_on_queue(message)
-
-    # Update the DynamoDB table with the status of the processing of this record.
-    dynamodb_client.update_processed_record(
-        record['identifier'],
-        message if message is not None and len(message) > 0 else '-',
-        status,
-        reason
-    )
+        logging.exception(
+            'An error occurred processing EPrints record [%s]',
+            record['identifier']
+        )
+        raise MessageGenerationError(err_code, str(e), message, message_obj)
+
+
+def _generate_message_in_worker(record, s3_objects):
+    return _generate_message(worker_context, record, s3_objects)
 
-    # Update the high watermark to the datestamp of this record.
-    dynamodb_client.update_high_watermark(record['datestamp'])
 
+def _plain_record(record):
+    # Lazily parsed metadata holds on to XML elements, which can't be sent to a worker process.
+    return {key: dict(value) if key == 'oai_dc' else value for key, value in record.items()}
 
-def _push_files_to_s3(record):
-    s3_file_locations = []
-    for file_location in record['file_locations']:
-        file_path = download_client.download_file(file_location)
-        if file_path is not None:
-            s3_file_locations.append(
-                s3_client.push_to_bucket(file_location, file_path)
+
+def _flush_pending(context, pending):
+    """ Puts the messages of the successfully processed records onto the stream in a single batch,
+        then records the status of every pending record in DynamoDB.
+        """
+    if not pending:
+        return
+    dynamodb_client = context.dynamodb_client
+    kinesis_client = context.kinesis_client
+
+    successes = [index for index, (_, processed) in enumerate(pending) if processed[2] == 'Success']
+    if successes:
+        failures = kinesis_client.put_messages_batch([pending[i][1][1] for i in successes])
+        for batch_index, reason in failures.items():
+            record, (identifier, message, _, _) = pending[successes[batch_index]]
+            logging.error(
+                'Unable to put message for record [%s] onto stream: %s',
+                identifier,
+                reason
             )
-            try:
-                os.remove(file_path)
-            except FileNotFoundError:
-                logging.warning('An error occurred removing file [%s]', file_path)
-        else:
-            logging.warning('Unable to download file [%s], skipping file', file_location)
-    return s3_file_locations
+            message = _decorate_message_with_error(message, 'GENERR009', reason)
+            kinesis_client.put_invalid_message_on_queue(message)
+            pending[successes[batch_index]] = (record, (identifier, message, 'Failure', reason))
+
+    for record, (identifier, message, status, reason) in pending:
+        # Update the DynamoDB table with the status of the processing of this record.
+        dynamodb_client.update_processed_record(
+            identifier,
+            message if message is not None and len(message) > 0 else '-',
+            status,
+            reason
+        )
+
+    # The high watermark is only written once per batch, and only once the batch's processed
+    # records have been written, so it never moves past a record whose status wasn't recorded.
+    dynamodb_client.flush()
+    for record, _ in pending:
+        dynamodb_client.update_high_watermark(record['datestamp'])
+    dynamodb_client.flush_high_watermark()
+
+
+def _push_files_to_s3(context, record):
+    # Downloading and uploading are both I/O bound, so transfer the files concurrently.
+    s3_file_locations = context.file_executor.map(
+        functools.partial(_download_and_push_file, context),
+        record['file_locations']
+    )
+    return [location for location in s3_file_locations if location is not None]
 
 
-def _decorate_message_with_error(message, error_code, error_message):
-    # We need to be able to get the message as a dict
+def _download_and_push_file(context, file_location):
+    # Stream the file straight from the provider into S3, without writing it to disk.
+    stream = context.download_client.open_stream(file_location)
+    if stream is None:
+        logging.warning('Unable to download file [%s], skipping file', file_location)
+        return None
+    with stream:
+        return context.s3_client.upload_fileobj(file_location, stream)
+
+
+def _decorate_message_with_error(message, error_code, error_message, message_obj=None):
+    # We need to be able to get the message as a dict, so parse it unless the caller already has one
     try:
-        message = json.loads(message, strict=False)
+        if message_obj is None:
+            message_obj = orjson.loads(message)
     except Exception:
         logging.warning(
             'Unable to decorate message [%s] with error code [%s] and message [%s]',
@@ -232,14 +449,14 @@ def _decorate_message_with_error(message, error_code, error_message):
         return message
 
     # Belts and braces - make sure the top level 'messageHeader' exists
-    if 'messageHeader' not in message:
-        message['messageHeader'] = {}
+    if 'messageHeader' not in message_obj:
+        message_obj['messageHeader'] = {}
 
     # Add the error code and error message to the message
-    message['messageHeader']['errorCode'] = error_code
-    message['messageHeader']['errorMessage'] = json.dumps(error_message)
+    message_obj['messageHeader']['errorCode'] = error_code
+    message_obj['messageHeader']['errorMessage'] = error_message
 
-    return json.dumps(message)
+    return orjson.dumps(message_obj).decode('utf-8')
 
 
 def _parse_env_vars(env_var_names):
@@ -254,8 +471,12 @@ def _parse_env_vars(env_var_names):
     return env_vars
 
 
+def _parse_optional_env_vars(env_var_defaults):
+    return {name: os.environ.get(name, default) for name, default in env_var_defaults.items()}
+
+
 def _get_settings():
-    return _parse_env_vars((
+    settings = _parse_env_vars((
         'OAI_PMH_PROVIDER',
         'OAI_PMH_ENDPOINT_URL',
         'JISC_ID',
@@ -268,14 +489,37 @@ def _get_settings():
         'RDSS_MESSAGE_API_SPECIFICATION_VERSION',
         'OAI_PMH_ADAPTOR_FLOW_LIMIT'
     ))
-
-
-def _shutdown():
+    settings.update(_parse_optional_env_vars({
+        'OUTPUT_KINESIS_BATCH_SIZE': '500',
+        'OAI_PMH_ADAPTOR_FILE_WORKERS': '8',
+        'OAI_PMH_ADAPTOR_RECORD_WORKERS': '4',
+        'OAI_PMH_ADAPTOR_CPU_WORKERS': '0',
+        'DYNAMODB_DAX_ENDPOINT': None,
+        'DYNAMODB_PROCESSED_TTL_SECONDS': '7776000'
+    }))
+    return settings
+
+
+def _shutdown(context):
     logging.info('Shutting adaptor down...')
-    if kinesis_client is not None:
-        kinesis_client.put_message_on_queue(PoisonPill)
-    if message_validator is not None:
-        message_validator.shutdown()
+    # Records in flight still submit work to the other executors, so wait for them first.
+    if context.record_executor is not None:
+        context.record_executor.shutdown()
+    if context.cpu_executor is not None:
+        context.cpu_executor.shutdown()
+    if context.file_executor is not None:
+        context.file_executor.shutdown()
+    try:
+        if context.dynamodb_client is not None:
+            context.dynamodb_client.flush()
+            context.dynamodb_client.flush_high_watermark()
+    finally:
+        # The Kinesis queue worker keeps the process alive until it's stopped, so stop it even if
+        # DynamoDB couldn't be written to.
+        if context.kinesis_client is not None:
+            context.kinesis_client.put_message_on_queue(PoisonPill)
+        if context.message_validator is not None:
+            context.message_validator.shutdown()
 
 
 if __name__ == '__main__':
@@ -283,4 +527,3 @@ if __name__ == '__main__':
         main()
     except Exception:
         logging.exception('An unhandled error occurred in the main thread')
-        _shutdown()
@@ -46,6 +46,45 @@ def test_download_file_error(*args):
     assert file_path is None
 
 
+@requests_mock.mock()
+def test_open_stream_success(*args):
+    # Get a handle on the mocker - see https://github.com/pytest-dev/pytest/issues/2749
+    requests_mocker = args[0]
+
+    # Create the download client we'll be testing against
+    download_client = DownloadClient()
+
+    # Set up the mock response
+    response_data = _get_file_bytes('tests/app/data/smiling.png')
+    requests_mocker.get('http://eprints.test/download/file.dat', content=response_data)
+
+    # Attempt to stream the file, and verify the stream gives us the file contents
+    stream = download_client.open_stream('http://eprints.test/download/file.dat')
+    assert stream is not None
+    with stream:
+        assert response_data == stream.read()
+
+
+@requests_mock.mock()
+def test_open_stream_error(*args):
+    # Get a handle on the mocker - see https://github.com/pytest-dev/pytest/issues/2749
+    requests_mocker = args[0]
+
+    # Create the download client we'll be testing against
+    download_client = DownloadClient()
+
+    # Set up the mock response
+    requests_mocker.get(
+        'http://eprints.test/download/file.dat',
+        status_code=401,
+        reason='Not Found'
+    )
+
+    # Attempt to stream the file
+    stream = download_client.open_stream('http://eprints.test/download/file.dat')
+    assert stream is None
+
+
 def _get_file_bytes(file_path):
     with open(file_path, 'rb') as file:
         return file.read()
@@ -1,7 +1,10 @@
 import boto3
+import time
 
+from botocore.exceptions import ClientError
 from datetime import timedelta
 from dateutil import parser
+from mock import MagicMock, patch
 from moto import mock_dynamodb2
 from app import DynamoDBClient
 
@@ -47,18 +50,61 @@ def test_watermark_table():
     # Populate a high watermark row into the DynamoDB table
     test_high_watermark_value = parser.parse('2018-03-20T00:00:09')
     dynamodb_client.update_high_watermark(test_high_watermark_value)
+    dynamodb_client.update_high_watermark(test_high_watermark_value - timedelta(seconds=5))
+    dynamodb_client.flush_high_watermark()
 
-    # Verify that we get the correct response, with a second appended to the given high watermark
+    # Verify that we get the correct response, with a second appended to the latest high watermark
     high_watermark = dynamodb_client.fetch_high_watermark()
     assert high_watermark == test_high_watermark_value + timedelta(seconds=1)
 
 
+@mock_dynamodb2
+def test_flush_high_watermark_condition():
+    # Create the DynamoDB client we'll be testing against, with a mocked out UpdateItem
+    dynamodb_client = DynamoDBClient(
+        'rdss-eprints-adaptor-watermark-test',
+        'rdss-eprints-adaptor-processed-test'
+    )
+    dynamodb_client.client.update_item = MagicMock(return_value={})
+
+    # Verify that the high watermark is only written if it moves forwards
+    dynamodb_client.update_high_watermark(parser.parse('2018-03-20T00:00:09'))
+    dynamodb_client.flush_high_watermark()
+    _, kwargs = dynamodb_client.client.update_item.call_args
+    assert kwargs['ConditionExpression'] == 'attribute_not_exists(#V) OR #V < :new'
+    assert kwargs['ExpressionAttributeNames'] == {'#V': 'Value'}
+    assert kwargs['ExpressionAttributeValues'][':new'] == {'S': '2018-03-20T00:00:10'}
+    assert dynamodb_client.pending_watermark is None
+
+    # Verify that nothing is written when there's no pending high watermark
+    dynamodb_client.flush_high_watermark()
+    assert dynamodb_client.client.update_item.call_count == 1
+
+    # Verify that a high watermark that doesn't move forwards is discarded
+    dynamodb_client.client.update_item = MagicMock(side_effect=ClientError(
+        {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem'))
+    dynamodb_client.update_high_watermark(parser.parse('2018-03-19T00:00:09'))
+    dynamodb_client.flush_high_watermark()
+    assert dynamodb_client.pending_watermark is None
+
+    # Verify that any other error is raised
+    dynamodb_client.client.update_item = MagicMock(side_effect=ClientError(
+        {'Error': {'Code': 'AccessDeniedException'}}, 'UpdateItem'))
+    dynamodb_client.update_high_watermark(parser.parse('2018-03-21T00:00:09'))
+    try:
+        dynamodb_client.flush_high_watermark()
+        assert False
+    except ClientError as e:
+        assert e.response['Error']['Code'] == 'AccessDeniedException'
+
+
 @mock_dynamodb2
 def test_processed_table():
     # Create the DynamoDB client we'll be testing against
     dynamodb_client = DynamoDBClient(
         'rdss-eprints-adaptor-watermark-test',
-        'rdss-eprints-adaptor-processed-test'
+        'rdss-eprints-adaptor-processed-test',
+        processed_ttl=3600
     )
 
     # Create a Boto3 DynamoDB client we'll use to create the mock table
@@ -101,7 +147,119 @@ def test_processed_table():
 
     # Populate a processed record into the DynamoDB table
     dynamodb_client.update_processed_record('eprints-identifier-test', '{}', 'Success', '-')
+    dynamodb_client.flush()
 
     # Verify that we get the correct response
     processed_status = dynamodb_client.fetch_processed_status('eprints-identifier-test')
     assert processed_status == 'Success'
+
+    # Verify that fetching statuses in bulk only returns the identifiers that have been processed
+    processed_statuses = dynamodb_client.fetch_processed_statuses(
+        ['eprints-identifier-test', 'eprints-identifier-unknown']
+    )
+    assert processed_statuses == {'eprints-identifier-test': 'Success'}
+
+    # Verify that the processed record expires after the given TTL
+    item = boto3_client.get_item(
+        TableName='rdss-eprints-adaptor-processed-test',
+        Key={'Identifier': {'S': 'eprints-identifier-test'}}
+    )['Item']
+    assert 0 < int(item['ExpiresAt']['N']) - time.time() <= 3600
+
+
+@mock_dynamodb2
+def test_flush_raises_write_error():
+    # Create the DynamoDB client we'll be testing against, failing every write
+    dynamodb_client = DynamoDBClient(
+        'rdss-eprints-adaptor-watermark-test',
+        'rdss-eprints-adaptor-processed-test'
+    )
+    dynamodb_client.client.batch_write_item = MagicMock(side_effect=ValueError('Test Error'))
+
+    # Verify that the error writing the processed record is raised when the queue is flushed
+    dynamodb_client.update_processed_record('eprints-identifier-test', '{}', 'Success', '-')
+    try:
+        dynamodb_client.flush()
+        assert False
+    except ValueError as e:
+        assert str(e) == 'Test Error'
+
+    # Verify that the error is only raised once
+    dynamodb_client.flush()
+
+
+@mock_dynamodb2
+@patch('app.dynamodb_client.time.sleep')
+def test_fetch_processed_statuses_unprocessed_keys(_sleep):
+    # Create the DynamoDB client we'll be testing against, with BatchGetItem leaving a key
+    # unprocessed once
+    dynamodb_client = DynamoDBClient(
+        'rdss-eprints-adaptor-watermark-test',
+        'rdss-eprints-adaptor-processed-test'
+    )
+    unprocessed_keys = {
+        'rdss-eprints-adaptor-processed-test': {
+            'Keys': [{'Identifier': {'S': 'eprints-identifier-2'}}],
+            'ProjectionExpression': 'Identifier, #S',
+            'ExpressionAttributeNames': {'#S': 'Status'}
+        }
+    }
+    dynamodb_client.client.batch_get_item = MagicMock(side_effect=[
+        {
+            'Responses': {
+                'rdss-eprints-adaptor-processed-test': [
+                    {'Identifier': {'S': 'eprints-identifier-1'}, 'Status': {'S': 'Success'}}
+                ]
+            },
+            'UnprocessedKeys': unprocessed_keys
+        },
+        {
+            'Responses': {
+                'rdss-eprints-adaptor-processed-test': [
+                    {'Identifier': {'S': 'eprints-identifier-2'}, 'Status': {'S': 'Failure'}}
+                ]
+            },
+            'UnprocessedKeys': {}
+        }
+    ])
+
+    # Verify that the unprocessed key is requested again, and its status returned
+    processed_statuses = dynamodb_client.fetch_processed_statuses(
+        ['eprints-identifier-1', 'eprints-identifier-2']
+    )
+    assert processed_statuses == {
+        'eprints-identifier-1': 'Success',
+        'eprints-identifier-2': 'Failure'
+    }
+    assert dynamodb_client.client.batch_get_item.call_count == 2
+    dynamodb_client.client.batch_get_item.assert_called_with(RequestItems=unprocessed_keys)
+
+
+@mock_dynamodb2
+@patch('app.dynamodb_client.time.sleep')
+def test_flush_writes_unprocessed_items(_sleep):
+    # Create the DynamoDB client we'll be testing against, with BatchWriteItem leaving an item
+    # unprocessed once
+    dynamodb_client = DynamoDBClient(
+        'rdss-eprints-adaptor-watermark-test',
+        'rdss-eprints-adaptor-processed-test'
+    )
+    dynamodb_client.client.batch_write_item = MagicMock(
+        side_effect=lambda RequestItems: {
+            'UnprocessedItems': {
+                'rdss-eprints-adaptor-processed-test': RequestItems[
+                    'rdss-eprints-adaptor-processed-test'][1:]
+            }
+        } if len(RequestItems['rdss-eprints-adaptor-processed-test']) > 1 else {}
+    )
+
+    # Verify that the unprocessed item is written again on its own
+    dynamodb_client.update_processed_record('eprints-identifier-1', '{}', 'Success', '-')
+    dynamodb_client.update_processed_record('eprints-identifier-2', '{}', 'Failure', 'Error')
+    dynamodb_client.flush()
+    assert dynamodb_client.client.batch_write_item.call_count == 2
+    _, kwargs = dynamodb_client.client.batch_write_item.call_args
+    requests = kwargs['RequestItems']['rdss-eprints-adaptor-processed-test']
+    assert [request['PutRequest']['Item']['Identifier']['S'] for request in requests] == [
+        'eprints-identifier-2'
+    ]
@@ -4,6 +4,8 @@ import time
 
 from app import KinesisClient
 from app import PoisonPill
+from app.kinesis_client import PUT_RECORDS_MAX_ATTEMPTS
+from mock import MagicMock, patch
 from moto import mock_kinesis
 
 
@@ -54,5 +56,109 @@ def test_put_message_on_queue():
     assert test_message == json_data
 
 
+@mock_kinesis
+def test_put_messages_batch():
+    # Create the Kinesis client we'll be testing against
+    kinesis_client = KinesisClient(
+        'rdss-eprints-adaptor-test-stream',
+        'rdss-eprints-adaptor-invalid-stream'
+    )
+
+    # Create a Boto3 Kinesis client we'll use to cretae the stream
+    client = boto3.client('kinesis')
+    client.create_stream(
+        StreamName='rdss-eprints-adaptor-test-stream',
+        ShardCount=1
+    )
+
+    # Put a batch of test JSON messages directly onto the stream
+    test_message = _get_test_message()
+    failures = kinesis_client.put_messages_batch([json.dumps(test_message)] * 3)
+    assert failures == {}
+
+    # Kill the queue worker, it isn't needed for batches
+    kinesis_client.put_message_on_queue(PoisonPill)
+
+    # Fetch the messages from the stream, to ensure they were all added
+    shard_id = client.describe_stream(
+        StreamName='rdss-eprints-adaptor-test-stream'
+    )['StreamDescription']['Shards'][0]['ShardId']
+    shard_iterator = client.get_shard_iterator(
+        StreamName='rdss-eprints-adaptor-test-stream',
+        ShardId=shard_id,
+        ShardIteratorType='TRIM_HORIZON'
+    )['ShardIterator']
+    response = client.get_records(
+        ShardIterator=shard_iterator
+    )
+
+    # Extract the JSON payloads and validate they match the input message
+    assert len(response['Records']) == 3
+    for record in response['Records']:
+        assert test_message == json.loads(record['Data'])
+
+
+@mock_kinesis
+@patch('app.kinesis_client.time.sleep')
+def test_put_messages_batch_retries_failed_records(_sleep):
+    # Create the Kinesis client we'll be testing against, with PutRecords failing the second record
+    # once
+    kinesis_client = KinesisClient(
+        'rdss-eprints-adaptor-test-stream',
+        'rdss-eprints-adaptor-invalid-stream'
+    )
+    kinesis_client.put_message_on_queue(PoisonPill)
+    kinesis_client.client.put_records = MagicMock(side_effect=[
+        {
+            'FailedRecordCount': 1,
+            'Records': [
+                {'SequenceNumber': '1', 'ShardId': 'shardId-000000000000'},
+                {'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'Slow'},
+                {'SequenceNumber': '2', 'ShardId': 'shardId-000000000000'}
+            ]
+        },
+        {
+            'FailedRecordCount': 0,
+            'Records': [{'SequenceNumber': '3', 'ShardId': 'shardId-000000000000'}]
+        }
+    ])
+
+    # Verify that every message is put, and that only the failed record is retried
+    failures = kinesis_client.put_messages_batch(['{"a": 1}', '{"b": 2}', '{"c": 3}'])
+    assert failures == {}
+    assert kinesis_client.client.put_records.call_count == 2
+    _, kwargs = kinesis_client.client.put_records.call_args
+    assert [record['Data'] for record in kwargs['Records']] == [b'{"b": 2}']
+
+
+@mock_kinesis
+@patch('app.kinesis_client.time.sleep')
+def test_put_messages_batch_gives_up(_sleep):
+    # Create the Kinesis client we'll be testing against, with PutRecords always failing the second
+    # record
+    kinesis_client = KinesisClient(
+        'rdss-eprints-adaptor-test-stream',
+        'rdss-eprints-adaptor-invalid-stream'
+    )
+    kinesis_client.put_message_on_queue(PoisonPill)
+
+    def put_records(StreamName, Records):
+        return {
+            'FailedRecordCount': 1,
+            'Records': [
+                {'ErrorCode': 'InternalFailure', 'ErrorMessage': 'Broken'}
+                if record['Data'] == b'{"b": 2}' else {'SequenceNumber': '1'}
+                for record in Records
+            ]
+        }
+
+    kinesis_client.client.put_records = MagicMock(side_effect=put_records)
+
+    # Verify that the failed message is given up on after the maximum number of attempts
+    failures = kinesis_client.put_messages_batch(['{"a": 1}', '{"b": 2}'])
+    assert failures == {1: 'InternalFailure: Broken'}
+    assert kinesis_client.client.put_records.call_count == PUT_RECORDS_MAX_ATTEMPTS
+
+
 def _get_test_message():
     return json.load(open('tests/app/data/rdss-message.json'))
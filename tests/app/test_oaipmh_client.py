@@ -2,7 +2,6 @@ from mock import patch
 
 from app import OAIPMHClient
 from dateutil import parser
-from xml.dom import minidom
 from urllib.parse import parse_qs
 
 
@@ -143,7 +142,8 @@ def test_fetch_records_from(mock_urlopen):
 
 
 def _get_xml_file(file_path):
-    return minidom.parse(file_path).toxml()
+    with open(file_path, 'rb') as file:
+        return file.read()
 
 
 class MockResponse(object):
@@ -28,3 +28,34 @@ def test_push_to_bucket():
     assert object_metadata['file_checksum'] == 'DJomkLQb4mYNsqra0T2/BQ=='
     assert object_metadata['download_url'] == 's3://rdss-prints-adaptor-test-bucket' \
                                               '/download/file.dat'
+
+
+@mock_s3
+def test_upload_fileobj():
+    # Create the S3 client that we'll be testing against
+    s3_client = S3Client('rdss-prints-adaptor-test-bucket')
+
+    # Get a handle on the S3 connection and create the mock S3 bucket
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+
+    # Stream the test file to the mock S3 bucket, using the fake URL
+    with open('tests/app/data/smiling.png', 'rb') as fileobj:
+        object_metadata = s3_client.upload_fileobj(
+            'http://eprints.test/download/file.dat',
+            fileobj
+        )
+    assert object_metadata is not None
+    assert len(object_metadata) == 5
+
+    # Verify the fields returned match what is expected
+    assert object_metadata['file_name'] == 'file.dat'
+    assert object_metadata['file_path'] == 'download/file.dat'
+    assert object_metadata['file_size'] == 17280
+    assert object_metadata['file_checksum'] == 'DJomkLQb4mYNsqra0T2/BQ=='
+    assert object_metadata['download_url'] == 's3://rdss-prints-adaptor-test-bucket' \
+                                              '/download/file.dat'
+
+    # Verify the checksum was attached to the object's metadata
+    s3_object = conn.Object('rdss-prints-adaptor-test-bucket', 'download/file.dat')
+    assert s3_object.metadata == {'md5chksum': 'DJomkLQb4mYNsqra0T2/BQ=='}
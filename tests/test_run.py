@@ -1,4 +1,6 @@
+import io
 import json
+import orjson
 import os
 import run
 import datetime
@@ -12,7 +14,7 @@ from app import MessageValidator
 from app import PoisonPill
 from app import S3Client
 from dateutil import parser
-from mock import MagicMock, patch
+from mock import ANY, MagicMock, call, patch
 
 
 @patch('run._initialise_download_client')
@@ -56,19 +58,28 @@ def test_main(_initialise_s3_client, _initialise_message_validator, _initialise_
     mock_s3_client = _mock_s3_client()
     _initialise_s3_client.return_value = mock_s3_client
 
+    # Track the order of the DynamoDB writes
+    mock_dynamodb_writes = MagicMock()
+    for name in ('update_processed_record', 'flush', 'update_high_watermark',
+                 'flush_high_watermark'):
+        mock_dynamodb_writes.attach_mock(getattr(mock_dynamodb_client, name), name)
+
     # Execute the main function
     run.main()
 
     # Validate that the appropriate calls were made
     mock_dynamodb_client.fetch_high_watermark.assert_called_once_with()
-    # mock_oai_pmh_client.fetch_records_from.assert_called_once_with('1970-01-01T00:00:00')
-    mock_dynamodb_client.fetch_processed_status.assert_called_once_with('test-identifier')
-    mock_download_client.download_file.assert_called_once_with(
+    mock_oai_pmh_client.fetch_records_from.assert_called_once_with(
+        datetime.datetime(1970, 1, 1, 0, 0, 0),
+        datetime.datetime(1970, 1, 2, 0, 0, 0)
+    )
+    mock_dynamodb_client.fetch_processed_statuses.assert_called_once_with(['test-identifier'])
+    mock_download_client.open_stream.assert_called_once_with(
         'http://eprints.test/download/file.dat'
     )
-    mock_s3_client.push_to_bucket.assert_called_once_with(
+    mock_s3_client.upload_fileobj.assert_called_once_with(
         'http://eprints.test/download/file.dat',
-        '/path/to/file.dat'
+        mock_download_client.open_stream.return_value
     )
     mock_message_generator.generate_metadata_create.assert_called_once_with(
         {
@@ -97,12 +108,232 @@ def test_main(_initialise_s3_client, _initialise_message_validator, _initialise_
                             'e.dat'
         }]
     )
-    assert mock_kinesis_client.put_message_on_queue.call_count == 2
+    mock_kinesis_client.put_messages_batch.assert_called_once_with(
+        [orjson.dumps(json.load(open('tests/app/data/rdss-message.json'))).decode('utf-8')]
+    )
+    mock_kinesis_client.put_message_on_queue.assert_called_once_with(PoisonPill)
+    mock_dynamodb_client.update_high_watermark.assert_called_once_with(
+        parser.parse('2004-02-16T14:10:55')
+    )
+    mock_dynamodb_client.flush_high_watermark.assert_called_with()
+    # The high watermark is only written once the processed records have been written
+    assert mock_dynamodb_writes.mock_calls[:4] == [
+        call.update_processed_record('test-identifier', ANY, 'Success', '-'),
+        call.flush(),
+        call.update_high_watermark(parser.parse('2004-02-16T14:10:55')),
+        call.flush_high_watermark()
+    ]
+
+
+@patch('run._initialise_download_client')
+@patch('run._initialise_dynamodb_client')
+@patch('run._initialise_oai_pmh_client')
+@patch('run._initialise_kinesis_client')
+@patch('run._initialise_message_generator')
+@patch('run._initialise_message_validator')
+@patch('run._initialise_s3_client')
+def test_main_query_windows(_initialise_s3_client, _initialise_message_validator,
+                            _initialise_message_generator, _initialise_kinesis_client,
+                            _initialise_oai_pmh_client, _initialise_dynamodb_client,
+                            _initialise_download_client):
+    # Initialise the test environment variables
+    _initialise_env_variables()
+
+    # Mock out the clients, with a high watermark 100 days ago
+    start_timestamp = datetime.datetime.combine(
+        datetime.date.today() - datetime.timedelta(days=100), datetime.time())
+    mock_dynamodb_client = _mock_dynamodb_client()
+    mock_dynamodb_client.fetch_high_watermark = MagicMock(return_value=start_timestamp)
+    _initialise_dynamodb_client.return_value = mock_dynamodb_client
+    _initialise_download_client.return_value = _mock_download_client()
+    _initialise_kinesis_client.return_value = _mock_kinesis_client()
+    _initialise_message_generator.return_value = _mock_message_generator()
+    _initialise_message_validator.return_value = _mock_message_validator()
+    _initialise_s3_client.return_value = _mock_s3_client()
+
+    # Mock out the OAI PMH client, so that only the query up to today has any records
+    mock_oai_pmh_client = _mock_oai_pmh_client()
+    records = mock_oai_pmh_client.fetch_records_from.return_value
+    mock_oai_pmh_client.fetch_records_from = MagicMock(
+        side_effect=lambda from_timestamp, until_timestamp: [] if until_timestamp else records
+    )
+    _initialise_oai_pmh_client.return_value = mock_oai_pmh_client
+
+    # Execute the main function
+    run.main()
+
+    # Verify that the windows double each time they're empty, up to 32 days, and that the last
+    # query is open ended once a window would reach past today
+    def days(n):
+        return start_timestamp + datetime.timedelta(days=n)
+
+    assert mock_oai_pmh_client.fetch_records_from.call_args_list == [
+        call(days(0), days(1)),
+        call(days(1), days(3)),
+        call(days(3), days(7)),
+        call(days(7), days(15)),
+        call(days(15), days(31)),
+        call(days(31), days(63)),
+        call(days(63), days(95)),
+        call(days(95), None)
+    ]
     mock_dynamodb_client.update_high_watermark.assert_called_once_with(
         parser.parse('2004-02-16T14:10:55')
     )
 
 
+def test_fetch_unprocessed_records():
+    # Mock out 250 records, where the first 150 have already been processed successfully
+    records = [{'identifier': 'test-identifier-{}'.format(i)} for i in range(250)]
+    context = run.Context()
+    context.oai_pmh_client = MagicMock()
+    context.oai_pmh_client.fetch_records_from = MagicMock(return_value=records)
+    context.dynamodb_client = MagicMock()
+    context.dynamodb_client.fetch_processed_statuses = MagicMock(
+        side_effect=lambda identifiers: {
+            identifier: 'Success' for identifier in identifiers
+            if int(identifier.rsplit('-', 1)[1]) < 150
+        }
+    )
+
+    start_timestamp = datetime.datetime(2018, 1, 1)
+    unprocessed_records = run._fetch_unprocessed_records(context, 20, start_timestamp)
+
+    # Verify that the first unprocessed records are returned, and that statuses are only fetched
+    # until enough of them have been found
+    assert unprocessed_records == records[150:170]
+    context.oai_pmh_client.fetch_records_from.assert_called_once_with(start_timestamp, None)
+    assert context.dynamodb_client.fetch_processed_statuses.call_args_list == [
+        call([record['identifier'] for record in records[:100]]),
+        call([record['identifier'] for record in records[100:200]])
+    ]
+
+
+def test_flush_pending_with_failed_messages():
+    message = json.dumps(json.load(open('tests/app/data/rdss-message.json')))
+
+    # Mock out a Kinesis client that can't put the first message onto the stream
+    context = run.Context()
+    context.dynamodb_client = MagicMock()
+    context.kinesis_client = MagicMock()
+    context.kinesis_client.put_messages_batch = MagicMock(
+        return_value={0: 'InternalFailure: Broken'})
+
+    run._flush_pending(context, [
+        ({'datestamp': parser.parse('2004-02-16T14:10:55')},
+         ('test-identifier-1', message, 'Success', '-')),
+        ({'datestamp': parser.parse('2004-02-16T14:10:56')},
+         ('test-identifier-2', message, 'Success', '-'))
+    ])
+
+    # Verify that the failed message is decorated with an error and put onto the invalid stream
+    context.kinesis_client.put_messages_batch.assert_called_once_with([message, message])
+    context.kinesis_client.put_invalid_message_on_queue.assert_called_once_with(ANY)
+    invalid_message = context.kinesis_client.put_invalid_message_on_queue.call_args[0][0]
+    message_header = json.loads(invalid_message)['messageHeader']
+    assert message_header['errorCode'] == 'GENERR009'
+    assert message_header['errorMessage'] == 'InternalFailure: Broken'
+
+    # Verify that the failed record is recorded as a failure, and the other as a success
+    assert context.dynamodb_client.update_processed_record.call_args_list == [
+        call('test-identifier-1', invalid_message, 'Failure', 'InternalFailure: Broken'),
+        call('test-identifier-2', message, 'Success', '-')
+    ]
+    context.dynamodb_client.update_high_watermark.assert_called_with(
+        parser.parse('2004-02-16T14:10:56'))
+
+
+def test_shutdown_after_dynamodb_error():
+    # Mock out a DynamoDB client that can't write the high watermark
+    context = run.Context()
+    context.dynamodb_client = MagicMock()
+    context.dynamodb_client.flush_high_watermark = MagicMock(side_effect=ValueError('Test Error'))
+    context.kinesis_client = MagicMock()
+    context.message_validator = MagicMock()
+
+    # Verify that the error is raised, but that the Kinesis queue worker is still stopped
+    try:
+        run._shutdown(context)
+        assert False
+    except ValueError as e:
+        assert str(e) == 'Test Error'
+    context.kinesis_client.put_message_on_queue.assert_called_once_with(PoisonPill)
+    context.message_validator.shutdown.assert_called_once_with()
+
+
+def test_decorate_message_with_error():
+    message = json.dumps(json.load(open('tests/app/data/rdss-message.json')))
+
+    # Decorate the message, both from its JSON string and from the already parsed message
+    for decorated in (
+        run._decorate_message_with_error(message, 'GENERR001', 'Test Error'),
+        run._decorate_message_with_error(message, 'GENERR001', 'Test Error', json.loads(message))
+    ):
+        message_header = json.loads(decorated)['messageHeader']
+        assert message_header['errorCode'] == 'GENERR001'
+        assert message_header['errorMessage'] == 'Test Error'
+
+    # A message that can't be parsed is returned as is
+    assert run._decorate_message_with_error(None, 'GENERR009', 'Test Error') is None
+
+
+def test_generate_message_in_worker_processes():
+    message = json.dumps(json.load(open('tests/app/data/rdss-message.json')))
+
+    # Mock out a message generator and validator that fail for some records
+    def generate_metadata_create(record, s3_objects):
+        return {
+            'test-identifier': message,
+            'invalid-identifier': '{"invalid": true}',
+            'unparseable-identifier': 'Not JSON'
+        }[record['identifier']]
+
+    def validate_message(message):
+        if '"invalid"' in message:
+            raise ValueError('Invalid message')
+
+    context = run.Context()
+    context.message_generator = _mock_message_generator()
+    context.message_generator.generate_metadata_create = MagicMock(
+        side_effect=generate_metadata_create)
+    context.message_validator = _mock_message_validator()
+    context.message_validator.validate_message = MagicMock(side_effect=validate_message)
+
+    # The generator and validator are inherited by the worker processes
+    cpu_executor = run._initialise_cpu_executor(context, {'OAI_PMH_ADAPTOR_CPU_WORKERS': '2'})
+    try:
+        def generate(identifier):
+            record = {'identifier': identifier, 'oai_dc': {'title': ['Test Title']}}
+            return cpu_executor.submit(
+                run._generate_message_in_worker,
+                run._plain_record(record),
+                []
+            ).result()
+
+        # Verify that a valid message comes back as is
+        assert generate('test-identifier') == orjson.dumps(json.loads(message)).decode('utf-8')
+
+        # Verify that an invalid message comes back as an error, with the parsed message
+        try:
+            generate('invalid-identifier')
+            assert False
+        except run.MessageGenerationError as e:
+            assert e.err_code == 'GENERR001'
+            assert e.reason == 'Invalid message'
+            assert e.message_obj == {'invalid': True}
+
+        # Verify that a message that isn't JSON comes back as an error, without a parsed message
+        try:
+            generate('unparseable-identifier')
+            assert False
+        except run.MessageGenerationError as e:
+            assert e.err_code == 'GENERR007'
+            assert e.message == 'Not JSON'
+            assert e.message_obj is None
+    finally:
+        cpu_executor.shutdown()
+
+
 def _initialise_env_variables():
     os.environ['OAI_PMH_ENDPOINT_URL'] = 'http://eprints.test/cgi/oai2'
     os.environ['OAI_PMH_PROVIDER'] = 'eprints'
@@ -119,7 +350,7 @@ def _initialise_env_variables():
 
 def _mock_download_client():
     mock_download_client = DownloadClient()
-    mock_download_client.download_file = MagicMock(return_value='/path/to/file.dat')
+    mock_download_client.open_stream = MagicMock(return_value=io.BytesIO(b'Test File'))
     return mock_download_client
 
 
@@ -131,8 +362,10 @@ def _mock_dynamodb_client():
     mock_dynamodb_client.fetch_high_watermark = MagicMock(
         return_value=datetime.datetime(1970, 1, 1, 0, 0, 0))
     mock_dynamodb_client.update_high_watermark = MagicMock(return_value=None)
-    mock_dynamodb_client.fetch_processed_status = MagicMock(return_value=None)
+    mock_dynamodb_client.flush_high_watermark = MagicMock(return_value=None)
+    mock_dynamodb_client.fetch_processed_statuses = MagicMock(return_value={})
     mock_dynamodb_client.update_processed_record = MagicMock(return_value=None)
+    mock_dynamodb_client.flush = MagicMock(return_value=None)
     return mock_dynamodb_client
 
 
@@ -170,6 +403,7 @@ def _mock_kinesis_client():
     mock_kinesis_client.put_message_on_queue(PoisonPill)
     mock_kinesis_client.put_message_on_queue = MagicMock(return_value=None)
     mock_kinesis_client.put_invalid_message_on_queue = MagicMock(return_value=None)
+    mock_kinesis_client.put_messages_batch = MagicMock(return_value={})
     return mock_kinesis_client
 
 
@@ -191,7 +425,7 @@ def _mock_message_validator():
 
 def _mock_s3_client():
     mock_s3_client = S3Client('rdss-prints-adaptor-test-bucket')
-    mock_s3_client.push_to_bucket = MagicMock(
+    mock_s3_client.upload_fileobj = MagicMock(
         return_value={
             'file_name': 'file.dat',
             'file_path': 'download/file.dat',